@@ -12,7 +12,8 @@ if ! test -e "${prefix}/run.py" -a -d "${prefix}/tests"; then
 fi
 
 # Remove the output directories.
-find "${prefix}/tests" -type d -name output -print0 | xargs -0 rm -rf
+find "${prefix}/tests" -type d \( -name output -o -name output-compare \) \
+     -print0 | xargs -0 rm -rf
 
 # Remove emacs backup files.
 find "${prefix}" -name \*~ -print0 | xargs -0 rm -f
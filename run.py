@@ -36,10 +36,19 @@ import glob
 import re
 import json
 import unittest
+import time
+import hashlib
+import tempfile
+import array
+import math
 from collections import namedtuple
+from collections import Counter
 
 import yaml
 
+# The suricata-verify directory, set again by main() from argv.
+TOPDIR = os.path.abspath(os.path.dirname(__file__))
+
 class SelfTest(unittest.TestCase):
 
     def test_parse_suricata_version(self):
@@ -76,6 +85,106 @@ class SelfTest(unittest.TestCase):
         self.assertFalse(version_equal("4.0", "4.1.3"))
         self.assertFalse(version_equal("4.0.2", "4.0.3"))
 
+    def test_diff_eve_digests(self):
+        a = {"timestamp": "2017-01-01T00:00:00", "flow_id": 1,
+             "event_type": "alert", "alert": {"signature_id": 1}}
+        b = {"timestamp": "2018-01-01T00:00:00", "flow_id": 2,
+             "event_type": "alert", "alert": {"signature_id": 1}}
+        self.assertEqual(event_digest(a), event_digest(b))
+
+        c = {"event_type": "alert", "alert": {"signature_id": 2}}
+        self.assertNotEqual(event_digest(a), event_digest(c))
+
+        base = {"alert": Counter([event_digest(a), event_digest(a)])}
+        compare = {"alert": Counter([event_digest(b), event_digest(c)]),
+                   "dns": Counter([event_digest({"event_type": "dns"})])}
+        self.assertEqual(
+            [("alert", 1, 1), ("dns", 0, 1)],
+            diff_eve_digests(base, compare))
+        self.assertEqual([], diff_eve_digests(base, base))
+
+    def test_stats_series(self):
+        series = StatsSeries()
+        series.add({"uptime": 0, "tcp": {"memuse": 100}})
+        series.add({"uptime": 8, "tcp": {"memuse": 300},
+                    "flow": {"memuse": 50}})
+        series.add({"uptime": 16, "tcp": {"memuse": 200},
+                    "flow": {"memuse": 40}})
+        self.assertEqual([100, 300, 200], series.values("tcp.memuse"))
+        self.assertEqual([(8, 50), (16, 40)], series.samples("flow.memuse"))
+        self.assertEqual([], series.values("flow.spare"))
+        self.assertEqual(200, series.last("tcp.memuse"))
+
+        # A counter missing from the final record has no last value.
+        gaps = StatsSeries()
+        gaps.add({"uptime": 0, "flow": {"active": 0}})
+        gaps.add({"uptime": 8})
+        self.assertEqual(None, gaps.last("flow.active"))
+        self.assertRaises(TestError, StatsSeriesCheck(
+            {"flow.active": {"last": 0}}, None).check, gaps)
+
+        self.assertTrue(StatsSeriesCheck({
+            "tcp.memuse": {"max": 300, "min": 100, "rate": 6.25,
+                           "last": 200, "last-max": 250},
+            "flow.memuse": {"monotonic": "decreasing"},
+        }, None).check(series))
+        self.assertTrue(StatsSeriesCheck({
+            "tcp.memuse": {"monotonic": False},
+        }, None).check(series))
+        for config in [
+                {"tcp.memuse": {"max": 299}},
+                {"tcp.memuse": {"last": 100}},
+                {"tcp.memuse": {"last-max": 199}},
+                {"flow.spare": {"last": 0}},
+                {"tcp.memuse": {"rate": 6}},
+                {"tcp.memuse": {"monotonic": True}},
+                {"tcp.memuse": {"monotonic": "up"}},
+                {"tcp.memuse": None},
+                {"tcp.memuse": 100},
+                {"tcp.memuse": {"max": "abc"}},
+                {"tcp.memuse": {"last": True}},
+                None,
+                ["tcp.memuse"],
+                {"flow.spare": {"max": 0}}]:
+            self.assertRaises(
+                TestError, StatsSeriesCheck(config, None).check, series)
+
+    def test_watcher(self):
+        topdir = tempfile.mkdtemp()
+        try:
+            tdir = os.path.join(topdir, "tests")
+            binary = os.path.join(topdir, "suricata")
+            for path in [
+                    binary,
+                    os.path.join(tdir, "t1", "test.yaml"),
+                    os.path.join(tdir, "t2", "expected", "eve.json"),
+                    os.path.join(tdir, "t2", "output", "eve.json")]:
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path, "w").close()
+            watcher = Watcher([binary], tdir, [], interval=0.01)
+
+            open(os.path.join(tdir, "t1", "test.yaml"), "w").write("x")
+            self.assertEqual(
+                (False, [os.path.join(tdir, "t1")]), watcher.wait())
+
+            open(os.path.join(tdir, "t2", "expected", "new"), "w").close()
+            self.assertEqual(
+                (False, [os.path.join(tdir, "t2")]), watcher.wait())
+
+            # Output is ignored, so only the binary change is seen.
+            open(os.path.join(tdir, "t2", "output", "eve.json"), "w").write(
+                "x")
+            open(binary, "w").write("x")
+            self.assertEqual((True, []), watcher.wait())
+
+            os.makedirs(os.path.join(tdir, "t3"))
+            open(os.path.join(tdir, "t3", "input.pcap"), "w").close()
+            self.assertEqual(
+                (False, [os.path.join(tdir, "t3")]), watcher.wait())
+        finally:
+            shutil.rmtree(topdir)
+
 class TestError(Exception):
     pass
 
@@ -85,6 +194,11 @@ class UnsatisfiedRequirementError(Exception):
 SuricataVersion = namedtuple(
     "SuricataVersion", ["major", "minor", "patch"])
 
+# The result of a single execution of a test. Elapsed is the wall time
+# in seconds and maxrss the peak resident set size of Suricata in
+# kilobytes, or None if it could not be measured.
+RunResult = namedtuple("RunResult", ["exit_code", "elapsed", "maxrss"])
+
 def parse_suricata_version(buf):
     m = re.search("(\d+)\.?(\d+)?\.?(\d+)?.*", str(buf).strip())
     if m:
@@ -108,8 +222,9 @@ def parse_suricata_version(buf):
 
     return None
 
-def get_suricata_version():
-    output = subprocess.check_output(["./src/suricata", "-V"])
+def get_suricata_version(srcdir="."):
+    output = subprocess.check_output(
+        [os.path.join(srcdir, "src/suricata"), "-V"])
     return parse_suricata_version(output)
 
 def version_equal(a, b):
@@ -150,6 +265,80 @@ def version_gte(v1, v2):
 
     return True
 
+def find_processes(pid, binary):
+    """Return the pids in the process tree rooted at pid that are
+    running binary."""
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        # No procfs on this platform.
+        return []
+
+    children = {}
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % (entry)) as fileobj:
+                # The command name may contain spaces and parentheses.
+                ppid = int(fileobj.read().rsplit(")", 1)[1].split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    binary = os.path.realpath(binary)
+    pids = []
+    pending = [pid]
+    while pending:
+        pid = pending.pop()
+        pending += children.get(pid, [])
+        try:
+            if os.readlink("/proc/%d/exe" % (pid)) == binary:
+                pids.append(pid)
+        except OSError:
+            continue
+    return pids
+
+def read_vmhwm(pid):
+    """Return the peak RSS in kilobytes of a process, or None."""
+    try:
+        with open("/proc/%d/status" % (pid)) as fileobj:
+            for line in fileobj:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+class RssSampler(threading.Thread):
+    """Sample the peak RSS of the Suricata processes started by a test.
+
+    The wait4 rusage can't be used as exec carries the RSS high water
+    mark of the runner into the child. Runs under valgrind, or too
+    short to be sampled, leave maxrss as None.
+    """
+
+    def __init__(self, pid, binary, interval=0.02):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.binary = binary
+        self.interval = interval
+        self.maxrss = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            for pid in find_processes(self.pid, self.binary):
+                hwm = read_vmhwm(pid)
+                if hwm is not None and hwm > (self.maxrss or 0):
+                    self.maxrss = hwm
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
 def pipe_reader(fileobj, output=None, verbose=False):
     for line in fileobj:
         line = line.decode()
@@ -160,14 +349,16 @@ def pipe_reader(fileobj, output=None, verbose=False):
 
 class SuricataConfig:
 
-    def __init__(self, version):
+    def __init__(self, version, srcdir="."):
         self.version = version
+        self.srcdir = srcdir
         self.features = set()
 
         self.load_build_info()
 
     def load_build_info(self):
-        output = subprocess.check_output(["./src/suricata", "--build-info"])
+        output = subprocess.check_output(
+            [os.path.join(self.srcdir, "src/suricata"), "--build-info"])
         for line in output.splitlines():
             if line.decode().startswith("Features:"):
                 self.features = set(line.decode().split()[1:])
@@ -206,6 +397,70 @@ def find_value(name, obj):
 
     return obj
 
+# Fields that differ from run to run and are ignored when comparing
+# the eve output of two builds.
+VOLATILE_EVE_FIELDS = ["timestamp", "flow_id"]
+
+def normalize_event(event):
+    """Return a copy of an eve event with the volatile fields removed,
+    at any depth."""
+    if isinstance(event, dict):
+        return dict((key, normalize_event(val))
+                    for key, val in event.items()
+                    if key not in VOLATILE_EVE_FIELDS)
+    elif isinstance(event, list):
+        return [normalize_event(val) for val in event]
+    return event
+
+def event_digest(event):
+    """Return a hash of the normalized form of an eve event."""
+    buf = json.dumps(normalize_event(event), sort_keys=True)
+    return hashlib.sha1(buf.encode()).hexdigest()
+
+def load_eve_digests(filename):
+    """Load an eve log as a dict of event_type to a Counter of event
+    digests, along with the last stats record. Raises ValueError on an
+    invalid line, as left by a crashing build.
+
+    Stats events are not digested as their values (uptime, memuse)
+    are expected to differ between runs.
+    """
+    digests = {}
+    stats = None
+    if not os.path.exists(filename):
+        return digests, stats
+    with open(filename, "r") as fileobj:
+        for lineno, line in enumerate(fileobj, 1):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                raise ValueError("invalid %s line %d" % (
+                    os.path.basename(filename), lineno))
+            event_type = event.get("event_type")
+            if event_type == "stats":
+                stats = event["stats"]
+                continue
+            if not event_type in digests:
+                digests[event_type] = Counter()
+            digests[event_type][event_digest(event)] += 1
+    return digests, stats
+
+def diff_eve_digests(a, b):
+    """Compare two sets of eve digests.
+
+    Returns a list of (event_type, only_in_a, only_in_b) tuples, one
+    for each event type whose events differ.
+    """
+    diffs = []
+    for event_type in sorted(set(a) | set(b)):
+        a_events = a.get(event_type, Counter())
+        b_events = b.get(event_type, Counter())
+        only_a = sum((a_events - b_events).values())
+        only_b = sum((b_events - a_events).values())
+        if only_a or only_b:
+            diffs.append((event_type, only_a, only_b))
+    return diffs
+
 class ShellCheck:
 
     def __init__(self, config):
@@ -240,6 +495,177 @@ class StatsCheck:
                     key, str(self.config[key]), str(val)))
         return True
 
+def flatten_stats(stats, prefix=""):
+    """Generate (path, value) tuples for each numeric counter in a stats
+    record, where path is the dotted name of the counter."""
+    for key, val in stats.items():
+        path = "%s%s" % (prefix, key)
+        if isinstance(val, dict):
+            for item in flatten_stats(val, "%s." % (path)):
+                yield item
+        elif isinstance(val, (int, float)) and not isinstance(val, bool):
+            yield path, val
+
+def format_counter(val):
+    if isinstance(val, float) and val.is_integer():
+        return "%d" % (val)
+    return str(val)
+
+class StatsSeries:
+    """A columnar store of the stats records of a run.
+
+    Each counter path maps to an array with one value per stats record,
+    NaN where the counter was not present in the record.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.columns = {}
+
+    def add(self, stats):
+        for path, val in flatten_stats(stats):
+            if not path in self.columns:
+                self.columns[path] = array.array(
+                    "d", [float("nan")] * self.count)
+            self.columns[path].append(val)
+        self.count += 1
+        for column in self.columns.values():
+            if len(column) < self.count:
+                column.append(float("nan"))
+
+    def samples(self, path, xpath="uptime"):
+        """Return the (x, value) pairs for a counter, skipping records
+        where either is missing."""
+        if not path in self.columns:
+            return []
+        if not xpath in self.columns:
+            return []
+        values = self.columns[path]
+        xs = self.columns[xpath]
+        return [(x, val) for x, val in zip(xs, values)
+                if not math.isnan(x) and not math.isnan(val)]
+
+    def last(self, path):
+        """Return the value of a counter in the final stats record, or
+        None if it is missing from that record."""
+        if not path in self.columns or math.isnan(self.columns[path][-1]):
+            return None
+        return self.columns[path][-1]
+
+    def values(self, path):
+        if not path in self.columns:
+            return []
+        return [val for val in self.columns[path] if not math.isnan(val)]
+
+def load_stats_series(filename):
+    series = StatsSeries()
+    with open(filename, "r") as fileobj:
+        for line in fileobj:
+            event = json.loads(line)
+            if event["event_type"] == "stats":
+                series.add(event["stats"])
+    return series
+
+class StatsSeriesCheck:
+    """Check how stats counters change over all the stats records of a
+    run, not just the last one."""
+
+    def __init__(self, config, outdir):
+        self.config = config
+        self.outdir = outdir
+
+    def run(self):
+        return self.check(load_stats_series("eve.json"))
+
+    def check(self, series):
+        if not isinstance(self.config, dict):
+            raise TestError(
+                "stats-series: expected a mapping of counters")
+        for path in self.config:
+            if not isinstance(self.config[path], dict):
+                raise TestError(
+                    "stats.%s: expected a mapping of assertions" % (path))
+            values = series.values(path)
+            if not values:
+                raise TestError("stats.%s: no values found" % (path))
+            for key, expected in self.config[path].items():
+                if key in ["max", "min", "last", "last-max", "rate"]:
+                    if not isinstance(expected, (int, float)) or \
+                       isinstance(expected, bool):
+                        raise TestError(
+                            "stats.%s: %s must be a number; got %s" % (
+                                path, key, str(expected)))
+                if key == "max":
+                    if max(values) > expected:
+                        raise TestError(
+                            "stats.%s: expected max %s; got %s" % (
+                                path, str(expected),
+                                format_counter(max(values))))
+                elif key == "min":
+                    if min(values) < expected:
+                        raise TestError(
+                            "stats.%s: expected min %s; got %s" % (
+                                path, str(expected),
+                                format_counter(min(values))))
+                elif key == "last":
+                    last = self.last(series, path)
+                    if last != expected:
+                        raise TestError(
+                            "stats.%s: expected last value %s; got %s" % (
+                                path, str(expected), format_counter(last)))
+                elif key == "last-max":
+                    last = self.last(series, path)
+                    if last > expected:
+                        raise TestError(
+                            "stats.%s: expected last value of at most %s; "
+                            "got %s" % (path, str(expected),
+                                        format_counter(last)))
+                elif key == "rate":
+                    rate = self.rate(series, path)
+                    if rate > expected:
+                        raise TestError(
+                            "stats.%s: expected rate of at most %s/s; "
+                            "got %.2f/s" % (path, str(expected), rate))
+                elif key == "monotonic":
+                    self.check_monotonic(path, values, expected)
+                else:
+                    raise TestError(
+                        "stats.%s: unknown assertion: %s" % (path, key))
+        return True
+
+    def last(self, series, path):
+        last = series.last(path)
+        if last is None:
+            raise TestError(
+                "stats.%s: not found in the last stats record" % (path))
+        return last
+
+    def rate(self, series, path):
+        """Return the change of a counter per second of uptime between
+        the first and last stats records."""
+        samples = series.samples(path)
+        if len(samples) < 2 or samples[-1][0] == samples[0][0]:
+            raise TestError(
+                "stats.%s: not enough stats records for a rate" % (path))
+        return (samples[-1][1] - samples[0][1]) / float(
+            samples[-1][0] - samples[0][0])
+
+    def check_monotonic(self, path, values, direction):
+        if direction is False:
+            return
+        if direction is True:
+            direction = "increasing"
+        if direction not in ["increasing", "decreasing"]:
+            raise TestError("stats.%s: bad monotonic direction: %s" % (
+                path, direction))
+        for prev, val in zip(values, values[1:]):
+            if (direction == "increasing" and val < prev) or \
+               (direction == "decreasing" and val > prev):
+                raise TestError("stats.%s: expected to be %s; "
+                                "went from %s to %s" % (
+                                    path, direction, format_counter(prev),
+                                    format_counter(val)))
+
 class FilterCheck:
 
     def __init__(self, config, outdir):
@@ -377,14 +803,15 @@ class TestRunner:
 
         if "files" in requires:
             for filename in requires["files"]:
-                if not os.path.exists(filename):
+                if not os.path.exists(os.path.join(self.cwd, filename)):
                     raise UnsatisfiedRequirementError(
                         "requires file %s" % (filename))
 
         if "script" in requires:
             for script in requires["script"]:
                 try:
-                    subprocess.check_call("%s" % script, shell=True)
+                    subprocess.check_call(
+                        "%s" % script, shell=True, cwd=self.cwd)
                 except:
                     raise UnsatisfiedRequirementError(
                         "requires script returned false")
@@ -401,14 +828,9 @@ class TestRunner:
                    glob.glob(os.path.join(self.directory, "*.pcapng")):
                     raise UnsatisfiedRequirementError("No pcap file found")
 
-    def run(self):
-
-        sys.stdout.write("===> %s: " % os.path.basename(self.directory))
-        sys.stdout.flush()
-
-        self.check_requires()
-        self.check_skip()
-
+    def prepare(self):
+        """Return the arguments, shell flag and environment to run the
+        test with."""
         shell = False
 
         if "command" in self.config:
@@ -426,41 +848,81 @@ class TestRunner:
             "ASAN_OPTIONS": "detect_leaks=0",
         }
 
-        if "count" in self.config:
-            count = self.config["count"]
-        else:
-            count = 1
+        return args, shell, env
 
+    def expected_exit_code(self):
         if "exit-code" in self.config:
-            expected_exit_code = self.config["exit-code"]
-        else:
-            expected_exit_code = 0
+            return self.config["exit-code"]
+        return 0
 
-        for _ in range(count):
+    def execute(self, args, shell, env, sample_rss=False):
+        """Run the test command once in a clean output directory.
+
+        Returns a RunResult with the exit code, wall time and, if
+        sample_rss is set, the peak RSS of Suricata.
+        """
+
+        self.readers = []
+
+        # Cleanup the output directory.
+        if os.path.exists(self.output):
+            shutil.rmtree(self.output)
+        os.makedirs(self.output)
+        self.setup()
+
+        stdout = open(os.path.join(self.output, "stdout"), "w")
+        stderr = open(os.path.join(self.output, "stderr"), "w")
+
+        open(os.path.join(self.output, "cmdline"), "w").write(
+            " ".join(args) + "\n")
+
+        start_time = time.time()
+
+        p = subprocess.Popen(
+            args, shell=shell, cwd=self.directory, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        self.start_reader(p.stdout, stdout)
+        self.start_reader(p.stderr, stderr)
 
-            # Cleanup the output directory.
-            if os.path.exists(self.output):
-                shutil.rmtree(self.output)
-            os.makedirs(self.output)
-            self.setup()
+        sampler = None
+        if sample_rss:
+            sampler = RssSampler(
+                p.pid, os.path.join(self.cwd, "src/suricata"))
+            sampler.start()
 
-            stdout = open(os.path.join(self.output, "stdout"), "w")
-            stderr = open(os.path.join(self.output, "stderr"), "w")
+        for r in self.readers:
+            r.join()
+
+        if sampler:
+            sampler.stop()
+        r = p.wait()
+
+        return RunResult(
+            exit_code=r,
+            elapsed=time.time() - start_time,
+            maxrss=sampler.maxrss if sampler else None)
+
+    def run(self):
+
+        sys.stdout.write("===> %s: " % os.path.basename(self.directory))
+        sys.stdout.flush()
+
+        self.check_requires()
+        self.check_skip()
 
-            open(os.path.join(self.output, "cmdline"), "w").write(
-                " ".join(args) + "\n")
+        args, shell, env = self.prepare()
 
-            p = subprocess.Popen(
-                args, shell=shell, cwd=self.directory, env=env,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if "count" in self.config:
+            count = self.config["count"]
+        else:
+            count = 1
 
-            self.start_reader(p.stdout, stdout)
-            self.start_reader(p.stderr, stderr)
+        expected_exit_code = self.expected_exit_code()
 
-            for r in self.readers:
-                r.join()
+        for _ in range(count):
 
-            r = p.wait()
+            r = self.execute(args, shell, env).exit_code
 
             if r != expected_exit_code:
                 raise TestError("got exit code %d, expected %d" % (
@@ -497,6 +959,11 @@ class TestRunner:
                         elif key == "stats":
                             if not StatsCheck(check[key], self.output).run():
                                 raise TestError("stats check did not pass")
+                        elif key == "stats-series":
+                            if not StatsSeriesCheck(
+                                    check[key], self.output).run():
+                                raise TestError(
+                                    "stats series check did not pass")
                         else:
                             raise TestError("Unknown check type: %s" % (key))
         finally:
@@ -587,6 +1054,104 @@ class TestRunner:
         t.start()
         self.readers.append(t)
 
+def format_delta(a, b, fmt):
+    """Format a base and compare value along with the relative change."""
+    if a is None or b is None:
+        return "n/a"
+    text = "%s -> %s" % (fmt % a, fmt % b)
+    if a:
+        text += " (%+.1f%%)" % (((b - a) * 100.0) / a)
+    return text
+
+class CompareRunner:
+    """Run a test against two Suricata builds at the same time and
+    compare their eve output, wall time, RSS and packet rate.
+
+    Only the eve output and exit codes decide the result; the test's
+    checks, check.sh and count are not used.
+    """
+
+    def __init__(self, base, compare):
+        self.base = base
+        self.compare = compare
+
+    def run(self):
+
+        sys.stdout.write("===> %s: " % os.path.basename(self.base.directory))
+        sys.stdout.flush()
+
+        for runner in [self.base, self.compare]:
+            runner.check_requires()
+            runner.check_skip()
+
+        prepared = [runner.prepare() for runner in [self.base, self.compare]]
+        results = [None, None]
+        errors = []
+
+        def execute(idx, runner, args, shell, env):
+            try:
+                results[idx] = runner.execute(
+                    args, shell, env, sample_rss=True)
+            except Exception as err:
+                errors.append(err)
+
+        threads = []
+        for idx, runner in enumerate([self.base, self.compare]):
+            t = threading.Thread(
+                target=execute, args=(idx, runner) + prepared[idx])
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if errors:
+            raise TestError(errors[0])
+
+        failures = []
+        eves = []
+        for name, runner, result in [
+                ("base", self.base, results[0]),
+                ("compare", self.compare, results[1])]:
+            expected_exit_code = runner.expected_exit_code()
+            if result.exit_code != expected_exit_code:
+                failures.append("%s got exit code %d, expected %d" % (
+                    name, result.exit_code, expected_exit_code))
+            try:
+                eves.append(load_eve_digests(
+                    os.path.join(runner.output, "eve.json")))
+            except ValueError as err:
+                failures.append("%s: %s" % (name, err))
+                eves.append(({}, None))
+
+        (base_digests, base_stats), (compare_digests, compare_stats) = eves
+        diffs = diff_eve_digests(base_digests, compare_digests)
+
+        if failures:
+            print("DIFF: %s" % ("; ".join(failures)))
+        elif diffs:
+            print("DIFF")
+        else:
+            print("OK")
+
+        for event_type, only_base, only_compare in diffs:
+            print("    %s: %d only in base, %d only in compare" % (
+                event_type, only_base, only_compare))
+
+        pps = []
+        for stats, result in [
+                (base_stats, results[0]), (compare_stats, results[1])]:
+            pkts = find_value("decoder.pkts", stats) if stats else None
+            if pkts is None or not result.elapsed:
+                pps.append(None)
+            else:
+                pps.append(pkts / result.elapsed)
+
+        print("    wall: %s; rss: %s; pkts/sec: %s" % (
+            format_delta(results[0].elapsed, results[1].elapsed, "%.3fs"),
+            format_delta(results[0].maxrss, results[1].maxrss, "%dKB"),
+            format_delta(pps[0], pps[1], "%.0f")))
+
+        return not failures and not diffs
+
 def check_deps():
     try:
         subprocess.check_call("jq --version > /dev/null 2>&1", shell=True)
@@ -602,6 +1167,173 @@ def check_deps():
 
     return True
 
+def load_suricata_config(srcdir, valgrind):
+    suricata_config = SuricataConfig(get_suricata_version(srcdir), srcdir)
+    suricata_config.valgrind = valgrind
+    return suricata_config
+
+def find_tests(tdir, patterns):
+    """Return the test directories in tdir that match any of the
+    patterns, in alphabetic order."""
+    tests = []
+    for dirpath, dirnames, filenames in os.walk(tdir):
+        # The top directory is not a test...
+        if dirpath == os.path.join(TOPDIR, "tests"):
+            continue
+        if dirpath == tdir:
+            continue
+
+        # We only want to go one level deep.
+        dirnames[0:] = []
+
+        if not patterns:
+            tests.append(dirpath)
+        else:
+            for pattern in patterns:
+                if os.path.basename(dirpath).find(pattern) > -1:
+                    tests.append(dirpath)
+
+    # Sort alphabetically.
+    tests.sort()
+
+    return tests
+
+def run_test(test_runner):
+    """Run a test, returning "passed", "failed" or "skipped"."""
+    try:
+        if test_runner.run():
+            return "passed"
+        return "failed"
+    except UnsatisfiedRequirementError as err:
+        print("SKIPPED: %s" % (str(err)))
+        return "skipped"
+    except TestError as err:
+        print("FAIL: %s" % (str(err)))
+        return "failed"
+
+def print_summary(results):
+    print("")
+    print("PASSED:  %d" % (results["passed"]))
+    print("FAILED:  %d" % (results["failed"]))
+    print("SKIPPED: %d" % (results["skipped"]))
+
+def get_mtime(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime, st.st_size)
+    except OSError:
+        return None
+
+class Watcher:
+    """Watch the Suricata binaries and the test directories for changes
+    by polling their modification times."""
+
+    def __init__(self, binaries, tdir, patterns, interval=0.2):
+        self.binaries = binaries
+        self.tdir = tdir
+        self.patterns = patterns
+        self.interval = interval
+        self.delay = interval
+
+        # The test list and directory listings are only refreshed when
+        # the mtime of their directory changes, so an idle poll is just
+        # a stat of each file.
+        self.tests = None
+        self.tdir_mtime = None
+        self.listings = {}
+
+        self.mtimes = self.scan()
+
+    def list_dir(self, path):
+        """Return the files and subdirectories of path, from the cache
+        if path hasn't changed."""
+        mtime = get_mtime(path)
+        if path in self.listings and self.listings[path][0] == mtime:
+            return self.listings[path][1:]
+        filenames = []
+        dirnames = []
+        try:
+            entries = os.listdir(path)
+        except OSError:
+            entries = []
+        for entry in entries:
+            if os.path.isdir(os.path.join(path, entry)):
+                # Don't watch our own output.
+                if entry not in ["output", "output-compare"]:
+                    dirnames.append(entry)
+            else:
+                filenames.append(entry)
+        self.listings[path] = (mtime, filenames, dirnames)
+        return filenames, dirnames
+
+    def scan(self):
+        mtimes = {}
+        for binary in self.binaries:
+            mtimes[binary] = get_mtime(binary)
+
+        tdir_mtime = get_mtime(self.tdir)
+        if self.tests is None or tdir_mtime != self.tdir_mtime:
+            self.tests = find_tests(self.tdir, self.patterns)
+            self.tdir_mtime = tdir_mtime
+
+        pending = list(self.tests)
+        while pending:
+            path = pending.pop()
+            filenames, dirnames = self.list_dir(path)
+            for filename in filenames:
+                filename = os.path.join(path, filename)
+                mtimes[filename] = get_mtime(filename)
+            pending += [os.path.join(path, dirname) for dirname in dirnames]
+        return mtimes
+
+    def poll(self):
+        """Sleep for the poll interval then scan.
+
+        On large test trees the interval is stretched so polling uses
+        no more than about a tenth of a core.
+        """
+        time.sleep(self.delay)
+        start_time = time.time()
+        mtimes = self.scan()
+        self.delay = max(self.interval, (time.time() - start_time) * 9)
+        return mtimes
+
+    def wait(self):
+        """Block until a change is seen.
+
+        Returns a tuple of whether a binary changed and the list of
+        test directories that changed.
+        """
+        mtimes = self.mtimes
+        while mtimes == self.mtimes:
+            mtimes = self.poll()
+
+        # Wait for the change to settle, the binary may still be in
+        # the process of being linked.
+        while True:
+            settled = self.poll()
+            if settled == mtimes and None not in [
+                    settled[binary] for binary in self.binaries]:
+                break
+            mtimes = settled
+
+        changed = [path for path in set(mtimes) | set(self.mtimes)
+                   if mtimes.get(path) != self.mtimes.get(path)]
+        self.mtimes = mtimes
+
+        binary_changed = False
+        tests = set()
+        for path in changed:
+            if path in self.binaries:
+                binary_changed = True
+            else:
+                name = os.path.relpath(path, self.tdir).split(os.sep)[0]
+                dirpath = os.path.join(self.tdir, name)
+                if os.path.isdir(dirpath):
+                    tests.add(dirpath)
+
+        return binary_changed, sorted(tests)
+
 def main():
     global TOPDIR
 
@@ -620,15 +1352,16 @@ def main():
                         help="Outputs to custom directory")
     parser.add_argument("--valgrind", dest="valgrind", action="store_true",
                         help="Run tests in with valgrind")
+    parser.add_argument("--compare", metavar="SRCDIR", action="store",
+                        help="Compare against the Suricata build in SRCDIR")
+    parser.add_argument("--watch", action="store_true",
+                        help="Rerun affected tests when Suricata or a test "
+                        "changes")
     parser.add_argument("patterns", nargs="*", default=[])
     args = parser.parse_args()
 
     TOPDIR = os.path.abspath(os.path.dirname(sys.argv[0]))
 
-    skipped = 0
-    passed = 0
-    failed = 0
-
     # Get the current working directory, which should be the top
     # suricata source directory.
     cwd = os.getcwd()
@@ -639,36 +1372,27 @@ def main():
         return 1
 
     # Create a SuricataConfig object that is passed to all tests.
-    suricata_config = SuricataConfig(get_suricata_version())
-    suricata_config.valgrind = args.valgrind
+    suricata_config = load_suricata_config(cwd, args.valgrind)
+
+    # And another for the build to compare against, if any.
+    compare_config = None
+    if args.compare:
+        compare_dir = os.path.abspath(args.compare)
+        if not (os.path.exists(os.path.join(compare_dir, "suricata.yaml")) and
+                os.path.exists(os.path.join(compare_dir, "src/suricata"))):
+            print("error: %s is not a suricata source directory or " % (
+                args.compare) + "suricata is not built")
+            return 1
+        compare_config = load_suricata_config(compare_dir, args.valgrind)
 
     tdir = os.path.join(TOPDIR, "tests")
     if args.testdir:
         tdir = os.path.abspath(args.testdir)
 
     # First gather the tests so we can run them in alphabetic order.
-    tests = []
-    for dirpath, dirnames, filenames in os.walk(tdir):
-        # The top directory is not a test...
-        if dirpath == os.path.join(TOPDIR, "tests"):
-            continue
-        if dirpath == tdir:
-            continue
-
-        # We only want to go one level deep.
-        dirnames[0:] = []
+    tests = find_tests(tdir, args.patterns)
 
-        if not args.patterns:
-            tests.append(dirpath)
-        else:
-            for pattern in args.patterns:
-                if os.path.basename(dirpath).find(pattern) > -1:
-                    tests.append(dirpath)
-
-    # Sort alphabetically.
-    tests.sort()
-
-    for dirpath in tests:
+    def make_runner(dirpath):
         name = os.path.basename(dirpath)
 
         outdir = os.path.join(dirpath, "output")
@@ -677,30 +1401,79 @@ def main():
 
         test_runner = TestRunner(
             cwd, dirpath, outdir, suricata_config, args.verbose)
+        if compare_config:
+            test_runner = CompareRunner(test_runner, TestRunner(
+                compare_config.srcdir, dirpath, "%s-compare" % (outdir),
+                compare_config, args.verbose))
+        return test_runner
+
+    if args.watch:
+        binaries = [os.path.join(cwd, "src/suricata")]
+        if compare_config:
+            binaries.append(os.path.join(compare_config.srcdir, "src/suricata"))
+        watcher = Watcher(binaries, tdir, args.patterns)
+
+        # Runners are kept between runs so test configs are only
+        # parsed again when their directory changes.
+        runners = {}
         try:
-            if test_runner.run():
-                passed += 1
-            else:
-                failed += 1
-                if args.fail:
-                    return 1
-        except UnsatisfiedRequirementError as err:
-            print("SKIPPED: %s" % (str(err)))
-            skipped += 1
-        except TestError as err:
-            print("FAIL: %s" % (str(err)))
-            failed += 1
-            if args.fail:
-                return 1
-        except Exception as err:
-            raise
+            while True:
+                results = Counter()
+                for dirpath in tests:
+                    # Errors like a half saved test.yaml shouldn't stop
+                    # us from watching.
+                    try:
+                        if dirpath not in runners:
+                            runners[dirpath] = make_runner(dirpath)
+                    except Exception as err:
+                        print("===> %s: FAIL: %s" % (
+                            os.path.basename(dirpath), str(err)))
+                        results["failed"] += 1
+                        continue
+                    try:
+                        results[run_test(runners[dirpath])] += 1
+                    except Exception as err:
+                        print("FAIL: %s" % (str(err)))
+                        runners.pop(dirpath, None)
+                        results["failed"] += 1
+                if tests:
+                    print_summary(results)
+                    print("")
+                print("Watching for changes...")
+
+                binary_changed, tests = watcher.wait()
+                if binary_changed:
+                    # The version and features may have changed with
+                    # the build.
+                    try:
+                        suricata_config = load_suricata_config(
+                            cwd, args.valgrind)
+                        if compare_config:
+                            compare_config = load_suricata_config(
+                                compare_config.srcdir, args.valgrind)
+                    except (subprocess.CalledProcessError, OSError) as err:
+                        print("error: failed to load suricata: %s" % (err))
+                        tests = []
+                        continue
+                    runners.clear()
+                    tests = find_tests(tdir, args.patterns)
+                else:
+                    for dirpath in tests:
+                        runners.pop(dirpath, None)
+                print("")
+        except KeyboardInterrupt:
+            return 0
+
+    results = Counter()
+    for dirpath in tests:
+        result = run_test(make_runner(dirpath))
+        results[result] += 1
+        if result == "failed" and args.fail:
+            return 1
 
-    print("")
-    print("PASSED:  %d" % (passed))
-    print("FAILED:  %d" % (failed))
-    print("SKIPPED: %d" % (skipped))
+    print_summary(results)
 
-    if failed > 0:
+    if results["failed"] > 0:
         return 1
     return 0
 